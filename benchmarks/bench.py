@@ -0,0 +1,258 @@
+"""Microbenchmarks for the model and serialization hot paths.
+
+Seeds a throwaway SQLite database per scale and times the models and the
+routes through the Flask test client. Results are written as JSON so two
+runs can be compared:
+
+    python benchmarks/bench.py --scales 1000,100000 --output before.json
+    python benchmarks/bench.py --scales 1000,100000 --compare before.json
+
+Each scale runs in its own process so engines, caches and memory
+measurements do not leak from one scale to the next.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+SEED_BATCH = 10000
+USER_PASSWORD = 'bench'
+
+BENCHMARKS = []
+
+def benchmark(name):
+    def decorator(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return decorator
+
+
+#--------------- SEEDING -----------------
+
+def seed(db, models, scale):
+    # one user per 100 catalog rows, so every user ends up with ~100 favorites of each kind
+    users = max(10, scale // 100)
+    tables = [
+        (models.User, lambda i: {"id": i, "name": "user%d" % i, "email": "user%d@bench.local" % i, "password": USER_PASSWORD}, users),
+        (models.Planet, lambda i: {"id": i, "name": "planet%d" % i}, scale),
+        (models.Character, lambda i: {"id": i, "name": "character%d" % i}, scale),
+        (models.FavoritePlanet, lambda i: {"id": i, "user": i % users + 1, "planet": i}, scale),
+        (models.FavoriteCharacter, lambda i: {"id": i, "user": i % users + 1, "character": i}, scale),
+    ]
+    for model, make_row, count in tables:
+        for start in range(1, count + 1, SEED_BATCH):
+            rows = [make_row(i) for i in range(start, min(start + SEED_BATCH, count + 1))]
+            db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
+    return users
+
+
+#--------------- BENCHMARKS -----------------
+# Each benchmark gets the context and returns the function to time.
+
+@benchmark('Planet.get_all')
+def bench_planet_get_all(ctx):
+    return lambda: ctx.models.Planet.get_all()
+
+@benchmark('Planet.serialize')
+def bench_planet_serialize(ctx):
+    planets = ctx.models.Planet.get_all()
+    return lambda: [planet.serialize() for planet in planets]
+
+@benchmark('Character.serialize')
+def bench_character_serialize(ctx):
+    characters = ctx.models.Character.get_all()
+    return lambda: [character.serialize() for character in characters]
+
+@benchmark('FavoritePlanet.serialize')
+def bench_fav_planet_serialize(ctx):
+    favorites = ctx.models.FavoritePlanet.get_all()
+    return lambda: [favorite.serialize() for favorite in favorites]
+
+# The two ways of building the full planet list: ORM instances plus
+# serialize() against the column-only rows used by the list routes
+@benchmark('Planet.get_all + serialize (ORM)')
+def bench_planet_list_orm(ctx):
+    return lambda: [planet.serialize() for planet in ctx.models.Planet.get_all()]
+
+@benchmark('Planet.get_all_rows + _asdict (columns)')
+def bench_planet_list_columns(ctx):
+    return lambda: [row._asdict() for row in ctx.models.Planet.get_all_rows()]
+
+@benchmark('GET /planets')
+def bench_get_planets(ctx):
+    return lambda: ctx.request('get', '/planets')
+
+@benchmark('GET /planets?stream=1')
+def bench_get_planets_stream(ctx):
+    return lambda: ctx.request('get', '/planets?stream=1')
+
+@benchmark('GET /users/favorites')
+def bench_get_user_fav(ctx):
+    return lambda: ctx.request('get', '/users/favorites', headers=ctx.auth)
+
+@benchmark('POST /login')
+def bench_create_token(ctx):
+    return lambda: ctx.request('post', '/login', json={"name": "user1", "password": USER_PASSWORD})
+
+@benchmark('POST+DELETE /favorite/planets/<id>')
+def bench_favorite_planet_roundtrip(ctx):
+    # Favorite i belongs to user i % users + 1 and users divides scale, so the
+    # last planet is user1's; the one before belongs to the last user, so
+    # user1 can add and remove it forever
+    url = '/favorite/planets/%d' % (ctx.scale - 1)
+    created = ctx.request('post', url, headers=ctx.auth).get_json()
+    assert 'planet-favorite' in created, 'POST %s did not create the favorite: %s' % (url, created)
+    ctx.request('delete', url, headers=ctx.auth)
+    def roundtrip():
+        ctx.request('post', url, headers=ctx.auth)
+        ctx.request('delete', url, headers=ctx.auth)
+    return roundtrip
+
+
+#--------------- RUNNER -----------------
+
+class Context:
+
+    def __init__(self, app, models, client, scale):
+        self.app = app
+        self.models = models
+        self.client = client
+        self.scale = scale
+        self.auth = None
+
+    def request(self, method, url, **kwargs):
+        response = getattr(self.client, method)(url, **kwargs)
+        response.get_data()
+        if response.status_code >= 400:
+            raise RuntimeError('%s %s returned %s' % (method.upper(), url, response.status_code))
+        return response
+
+def time_it(fn, repeat, min_time):
+    fn()
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < repeat or time.perf_counter() - started < min_time:
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+        if len(timings) >= repeat * 100:
+            break
+    return timings
+
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_scale(scale, repeat, min_time, only, memory):
+    db_path = os.path.join(tempfile.mkdtemp(prefix='starwars-bench-'), 'bench.db')
+    os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + db_path
+    # the benchmarks hit the same routes far more often than any client limit allows
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    sys.path.insert(0, os.path.abspath(SRC_DIR))
+    import models
+    from main import app
+
+    results = {}
+    with app.app_context():
+        models.db.create_all()
+        started = time.perf_counter()
+        seed(models.db, models, scale)
+        results['seed'] = {"seconds": time.perf_counter() - started}
+
+        ctx = Context(app, models, app.test_client(), scale)
+        token = ctx.request('post', '/login', json={"name": "user1", "password": USER_PASSWORD}).get_json()['token']
+        ctx.auth = {'Authorization': 'Bearer ' + token}
+
+        for name, make in BENCHMARKS:
+            if only and not any(part in name for part in only):
+                continue
+            fn = make(ctx)
+            timings = time_it(fn, repeat, min_time)
+            result = {
+                "runs": len(timings),
+                "min": min(timings),
+                "median": statistics.median(timings),
+                "mean": statistics.mean(timings),
+                "ops_per_sec": len(timings) / sum(timings),
+            }
+            if memory:
+                result["peak_bytes"] = peak_memory(fn)
+            results[name] = result
+            models.db.session.remove()
+    os.remove(db_path)
+    return results
+
+def compare(previous, current, threshold):
+    regressions = []
+    for scale, benchmarks in current["scales"].items():
+        for name, result in benchmarks.items():
+            before = previous.get("scales", {}).get(scale, {}).get(name)
+            if not before or "median" not in before:
+                continue
+            change = result["median"] / before["median"] - 1
+            flag = 'REGRESSION' if change > threshold else ''
+            print('%-8s %-40s %10.3fms -> %10.3fms %+7.1f%% %s' % (
+                scale, name, before["median"] * 1000, result["median"] * 1000, change * 100, flag))
+            if flag:
+                regressions.append((scale, name))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', default='1000,100000,1000000', help='comma separated row counts per table')
+    parser.add_argument('--repeat', type=int, default=5, help='minimum timed runs per benchmark')
+    parser.add_argument('--min-time', type=float, default=0.5, help='minimum seconds spent timing each benchmark')
+    parser.add_argument('--only', default='', help='comma separated substrings of benchmark names to run')
+    parser.add_argument('--memory', action='store_true', help='also record peak Python allocations (one extra run)')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--compare', help='previous JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='median slowdown reported as a regression')
+    parser.add_argument('--run-scale', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    only = [part for part in args.only.split(',') if part]
+
+    if args.run_scale:
+        results = run_scale(args.run_scale, args.repeat, args.min_time, only, args.memory)
+        json.dump(results, sys.stdout)
+        return
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "scales": {}
+    }
+    for scale in [int(scale) for scale in args.scales.split(',')]:
+        command = [sys.executable, os.path.abspath(__file__), '--run-scale', str(scale),
+                   '--repeat', str(args.repeat), '--min-time', str(args.min_time), '--only', args.only]
+        if args.memory:
+            command.append('--memory')
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+        report["scales"][str(scale)] = json.loads(output)
+        for name, result in report["scales"][str(scale)].items():
+            if "median" in result:
+                print('%-8s %-40s median %10.3fms  %10.1f ops/s' % (scale, name, result["median"] * 1000, result["ops_per_sec"]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Closed-loop HTTP load generator, to compare the WSGI and ASGI servers.
+
+Opens --concurrency keep-alive connections and sends --requests GETs in
+total, then prints throughput and latency percentiles:
+
+    python benchmarks/load.py http://localhost:3000/planets/1 --concurrency 64
+
+Uses only the standard library so it runs anywhere the API does.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+async def worker(host, port, path, headers, counter, latencies, errors):
+    request = ('GET %s HTTP/1.1\r\nHost: %s\r\n%sConnection: keep-alive\r\n\r\n' % (path, host, headers)).encode()
+    reader = writer = None
+    while counter[0] > 0:
+        counter[0] -= 1
+        start = time.perf_counter()
+        if writer is None:
+            # gunicorn's sync workers close the connection after every response
+            reader, writer = await asyncio.open_connection(host, port)
+        writer.write(request)
+        status_line = await reader.readline()
+        length = 0
+        keep_alive = True
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode().partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+            elif name.lower() == 'connection' and value.strip().lower() == 'close':
+                keep_alive = False
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - start)
+        if not status_line.split()[1].startswith(b'2'):
+            errors.append(status_line)
+        if not keep_alive:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+async def run(url, concurrency, requests, headers):
+    parts = urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    header_lines = ''.join('%s\r\n' % header for header in headers)
+    counter = [requests]
+    latencies = []
+    errors = []
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        worker(parts.hostname, parts.port or 80, path, header_lines, counter, latencies, errors)
+        for _ in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "url": url,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": elapsed,
+        "requests_per_sec": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--header', action='append', default=[], help='extra request header, e.g. "Authorization: Bearer ..."')
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.url, args.concurrency, args.requests, args.header)), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Worker boot time: how long a fresh process takes to import the app and
+answer its first request.
+
+Every run starts a new interpreter in src/ (as gunicorn does with
+--chdir ./src/), so nothing is cached between runs:
+
+    python benchmarks/startup.py --runs 10 --output startup.json
+    python benchmarks/startup.py --runs 10 --compare startup.json
+
+Also lists the modules with the largest cumulative import time, taken
+from python -X importtime.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+PROBE = '''
+import json, time
+start = time.perf_counter()
+import wsgi
+imported = time.perf_counter()
+client = wsgi.application.test_client()
+client.get('/metrics').get_data()
+served = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_request": served - imported}))
+'''
+
+def run_once(env, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', PROBE]
+    result = subprocess.run(command, cwd=SRC_DIR, env=env, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+def slowest_imports(stderr, top):
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative), name.rstrip()))
+    # the app's own modules and what they import directly (wsgi -> main -> ...)
+    modules = [(us, name.strip()) for us, name in modules if len(name) - len(name.lstrip()) in (3, 5)]
+    return [{"module": name, "ms": us / 1000} for us, name in sorted(modules, reverse=True)[:top]]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='number of slowest imports to list')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--compare', help='previous JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='median slowdown reported as a regression')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault('DB_CONNECTION_STRING', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'starwars-startup.db'))
+    env['PYTHONWARNINGS'] = 'ignore'
+    env['RATELIMIT_ENABLED'] = '0'
+
+    samples = [run_once(env)[0] for _ in range(args.runs)]
+    _, stderr = run_once(env, importtime=True)
+    report = {
+        "import_median": statistics.median(sample["import"] for sample in samples),
+        "first_request_median": statistics.median(sample["first_request"] for sample in samples),
+        "total_median": statistics.median(sample["import"] + sample["first_request"] for sample in samples),
+        "runs": samples,
+        "slowest_imports": slowest_imports(stderr, args.top),
+    }
+    print('import %.1fms  first request %.1fms  total %.1fms' % (
+        report["import_median"] * 1000, report["first_request_median"] * 1000, report["total_median"] * 1000))
+    for entry in report["slowest_imports"]:
+        print('  %8.1fms  %s' % (entry["ms"], entry["module"]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        change = report["total_median"] / previous["total_median"] - 1
+        print('total %.1fms -> %.1fms %+.1f%%' % (previous["total_median"] * 1000, report["total_median"] * 1000, change * 100))
+        if change > args.threshold:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+# Picked up automatically by `gunicorn wsgi --chdir ./src/` (see Procfile)
+import os
+import shutil
+import tempfile
+
+# prometheus_client reads this before the workers import it, so every
+# worker writes its metrics where /metrics can aggregate them
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'starwars-api-metrics'))
+
+from prometheus_client import multiprocess  # noqa: E402
+
+def on_starting(server):
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
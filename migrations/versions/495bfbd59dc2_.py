@@ -0,0 +1,41 @@
+"""add denormalized favorite counts to planets and characters
+
+Revision ID: 495bfbd59dc2
+Revises: 99225b56a06b
+Create Date: 2026-10-18 12:48:51.276630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '495bfbd59dc2'
+down_revision = '99225b56a06b'
+branch_labels = None
+depends_on = None
+
+
+def fill_counts(table_name, favorites_name, item_column):
+    table = sa.table(table_name, sa.column('id'), sa.column('favorite_count'))
+    favorites = sa.table(favorites_name, sa.column('id'), sa.column(item_column))
+    count = sa.select(sa.func.count(favorites.c.id)).where(favorites.c[item_column] == table.c.id).scalar_subquery()
+    op.execute(table.update().values(favorite_count=count))
+
+
+def upgrade():
+    op.add_column('planets', sa.Column('favorite_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('characters', sa.Column('favorite_count', sa.Integer(), server_default='0', nullable=False))
+    fill_counts('planets', 'favoritesPlanets', 'planet')
+    fill_counts('characters', 'favoritesCharacters', 'character')
+    op.create_index('ix_planets_favorite_count', 'planets', ['favorite_count'], unique=False)
+    op.create_index('ix_characters_favorite_count', 'characters', ['favorite_count'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_characters_favorite_count', table_name='characters')
+    op.drop_index('ix_planets_favorite_count', table_name='planets')
+    with op.batch_alter_table('characters') as batch_op:
+        batch_op.drop_column('favorite_count')
+    with op.batch_alter_table('planets') as batch_op:
+        batch_op.drop_column('favorite_count')
@@ -0,0 +1,39 @@
+"""index favorites tables and reject duplicate favorites
+
+Revision ID: 52acd0c2b0a2
+Revises: 8c88353b14e3
+Create Date: 2026-10-18 10:41:07.552904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '52acd0c2b0a2'
+down_revision = '8c88353b14e3'
+branch_labels = None
+depends_on = None
+
+
+def delete_duplicates(table_name, item_column):
+    # keep the oldest row of every (user, item) pair so the unique index can be built
+    table = sa.table(table_name, sa.column('id'), sa.column('user'), sa.column(item_column))
+    keep = sa.select(sa.func.min(table.c.id).label('id')).group_by(table.c.user, table.c[item_column]).subquery()
+    op.execute(table.delete().where(table.c.id.notin_(sa.select(keep.c.id))))
+
+
+def upgrade():
+    delete_duplicates('favoritesPlanets', 'planet')
+    delete_duplicates('favoritesCharacters', 'character')
+    op.create_index('ix_favoritesPlanets_user_planet', 'favoritesPlanets', ['user', 'planet'], unique=True)
+    op.create_index('ix_favoritesPlanets_planet', 'favoritesPlanets', ['planet'], unique=False)
+    op.create_index('ix_favoritesCharacters_user_character', 'favoritesCharacters', ['user', 'character'], unique=True)
+    op.create_index('ix_favoritesCharacters_character', 'favoritesCharacters', ['character'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_favoritesCharacters_character', table_name='favoritesCharacters')
+    op.drop_index('ix_favoritesCharacters_user_character', table_name='favoritesCharacters')
+    op.drop_index('ix_favoritesPlanets_planet', table_name='favoritesPlanets')
+    op.drop_index('ix_favoritesPlanets_user_planet', table_name='favoritesPlanets')
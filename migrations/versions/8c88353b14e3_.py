@@ -0,0 +1,32 @@
+"""add table versions for conditional GET
+
+Revision ID: 8c88353b14e3
+Revises: e3b5c361d33c
+Create Date: 2026-10-18 09:12:40.318215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c88353b14e3'
+down_revision = 'e3b5c361d33c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('tableVersions',
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [
+        {'name': 'planets', 'version': 0},
+        {'name': 'characters', 'version': 0},
+    ])
+
+
+def downgrade():
+    op.drop_table('tableVersions')
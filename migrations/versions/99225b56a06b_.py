@@ -0,0 +1,65 @@
+"""add name search indexes for planets and characters
+
+Revision ID: 99225b56a06b
+Revises: 52acd0c2b0a2
+Create Date: 2026-10-18 12:03:26.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '99225b56a06b'
+down_revision = '52acd0c2b0a2'
+branch_labels = None
+depends_on = None
+
+TABLES = ('planets', 'characters')
+
+
+def create_sqlite_fts(table):
+    # external content FTS5 table kept in sync with the catalog table by triggers
+    fts = table + '_fts'
+    op.execute("CREATE VIRTUAL TABLE \"%s\" USING fts5(name, content='%s', content_rowid='id', tokenize='trigram')" % (fts, table))
+    op.execute("INSERT INTO \"%s\"(\"%s\") VALUES ('rebuild')" % (fts, fts))
+    op.execute("""CREATE TRIGGER "%(fts)s_ai" AFTER INSERT ON "%(table)s" BEGIN
+        INSERT INTO "%(fts)s"(rowid, name) VALUES (new.id, new.name);
+    END""" % {'fts': fts, 'table': table})
+    op.execute("""CREATE TRIGGER "%(fts)s_ad" AFTER DELETE ON "%(table)s" BEGIN
+        INSERT INTO "%(fts)s"("%(fts)s", rowid, name) VALUES ('delete', old.id, old.name);
+    END""" % {'fts': fts, 'table': table})
+    op.execute("""CREATE TRIGGER "%(fts)s_au" AFTER UPDATE OF name ON "%(table)s" BEGIN
+        INSERT INTO "%(fts)s"("%(fts)s", rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO "%(fts)s"(rowid, name) VALUES (new.id, new.name);
+    END""" % {'fts': fts, 'table': table})
+
+
+def drop_sqlite_fts(table):
+    fts = table + '_fts'
+    for suffix in ('ai', 'ad', 'au'):
+        op.execute('DROP TRIGGER IF EXISTS "%s_%s"' % (fts, suffix))
+    op.execute('DROP TABLE IF EXISTS "%s"' % fts)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table in TABLES:
+            op.create_index('ix_%s_name_trgm' % table, table, ['name'],
+                            postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    elif dialect == 'sqlite':
+        for table in TABLES:
+            create_sqlite_fts(table)
+    # elsewhere the existing unique index on name serves prefix searches
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        for table in TABLES:
+            op.drop_index('ix_%s_name_trgm' % table, table_name=table)
+    elif dialect == 'sqlite':
+        for table in TABLES:
+            drop_sqlite_fts(table)
@@ -1,9 +1,11 @@
 import os
-from flask_admin import Admin
 from models import db, User
-from flask_admin.contrib.sqla import ModelView
 
 def setup_admin(app):
+    # imported here so workers started with ADMIN_ENABLED=0 never load Flask-Admin
+    from flask_admin import Admin
+    from flask_admin.contrib.sqla import ModelView
+
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
     admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
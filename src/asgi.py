@@ -0,0 +1,196 @@
+# Async variant of the read and favorites endpoints, for an ASGI server:
+#   uvicorn asgi:app --app-dir src --port 3000
+#   gunicorn asgi:app -k uvicorn.workers.UvicornWorker --chdir ./src/
+# Queries go through SQLAlchemy's asyncio engine (aiosqlite, asyncpg or
+# aiomysql depending on DB_CONNECTION_STRING), so one process keeps
+# serving other requests while a query waits on the database. Everything
+# else (signup, login, bulk, search, admin...) stays on the WSGI app.
+
+import json
+import re
+from urllib.parse import parse_qsl
+
+import jwt
+from sqlalchemy import select, update, delete, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from werkzeug.datastructures import MultiDict
+
+from main import app as flask_app
+from models import User, Planet, Character, FavoritePlanet, FavoriteCharacter
+from pool import engine_options_from_env
+from utils import APIException, get_page_args, serialize_page
+
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+}
+
+# url prefix -> (catalog model, favorite model, favorite column, label)
+CATALOG = {
+    'planets': (Planet, FavoritePlanet, 'planet', 'Planet'),
+    'people': (Character, FavoriteCharacter, 'character', 'Character'),
+}
+
+def async_url(url):
+    scheme, rest = url.split('://', 1)
+    dialect = scheme.split('+')[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise RuntimeError('The ASGI app supports %s databases, DB_CONNECTION_STRING uses %s'
+                           % (', '.join(sorted(ASYNC_DRIVERS)), dialect))
+    return ASYNC_DRIVERS[dialect] + '://' + rest
+
+def async_engine_options(url):
+    options = engine_options_from_env(url)
+    # the asyncio engine brings its own pool class
+    options.pop('poolclass', None)
+    return options
+
+database_url = flask_app.config['SQLALCHEMY_DATABASE_URI']
+engine = create_async_engine(async_url(database_url), **async_engine_options(database_url))
+Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+class Request:
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = MultiDict(parse_qsl(scope['query_string'].decode()))
+        self.headers = {name.decode().lower(): value.decode() for name, value in scope['headers']}
+        self.body = body
+
+    def jwt_claims(self):
+        auth = self.headers.get('authorization', '')
+        if not auth.startswith('Bearer '):
+            raise APIException('Missing Authorization Header', status_code=401)
+        try:
+            claims = jwt.decode(auth[7:], flask_app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
+        except jwt.PyJWTError as e:
+            raise APIException(str(e), status_code=401)
+        return claims
+
+
+#----------- CATALOG -------------------
+
+async def get_all(request, kind):
+    model = CATALOG[kind][0]
+    limit, after = get_page_args(request.args, flask_app.config['PAGE_DEFAULT_LIMIT'], flask_app.config['PAGE_MAX_LIMIT'])
+    query = select(model.id, model.name).order_by(model.id).limit(limit + 1)
+    if after is not None:
+        query = query.where(model.id > after)
+    async with Session() as session:
+        rows = (await session.execute(query)).all()
+    if not rows and after is None:
+        return 500, {"message": "%s doesnt exist" % ('Planet' if kind == 'planets' else 'People')}
+    return 200, serialize_page(rows, limit)
+
+async def get_one(request, kind, id):
+    model, _, _, label = CATALOG[kind]
+    async with Session() as session:
+        row = (await session.execute(select(model.id, model.name).where(model.id == id))).first()
+    if row is None:
+        raise APIException('%s not found' % label, status_code=404)
+    return 200, row._asdict()
+
+
+#------------- FAVORITES -----------------------
+
+async def get_user_fav(request):
+    user_id = request.jwt_claims()['sub']
+    results = []
+    async with Session() as session:
+        for kind in ('people', 'planets'):
+            model, fav_model, column, _ = CATALOG[kind]
+            fav_column = getattr(fav_model, column)
+            query = select(fav_model.id, fav_model.user, fav_column, model.name.label(column + '_name'))
+            query = query.outerjoin(model, model.id == fav_column).where(fav_model.user == user_id).order_by(fav_model.id)
+            results.append([row._asdict() for row in (await session.execute(query)).all()])
+    return 200, results
+
+async def add_favorite(request, kind, id):
+    claims = request.jwt_claims()
+    user_id = claims['sub']
+    model, fav_model, column, label = CATALOG[kind]
+    async with Session() as session:
+        item = (await session.execute(select(model.name).where(model.id == id))).first()
+        if item is None:
+            raise APIException('%s not found' % label, status_code=404)
+        user_name = claims.get('name')
+        if user_name is None:
+            user_name = (await session.execute(select(User.name).where(User.id == user_id))).scalar()
+        try:
+            await session.execute(insert(fav_model).values({"user": user_id, column: id}))
+            await session.execute(update(model).where(model.id == id).values(favorite_count=model.favorite_count + 1))
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            return 200, {'message': 'Data provided is not valid'}
+    return 200, {"id": user_id, "%s-favorite" % label.lower(): item.name, "name": user_name}
+
+async def delete_favorite(request, kind, id):
+    user_id = request.jwt_claims()['sub']
+    model, fav_model, column, label = CATALOG[kind]
+    async with Session() as session:
+        result = await session.execute(delete(fav_model).where(fav_model.user == user_id, getattr(fav_model, column) == id))
+        if not result.rowcount:
+            raise APIException('%s favorite not found' % label, status_code=404)
+        await session.execute(update(model).where(model.id == id).values(favorite_count=model.favorite_count - 1))
+        await session.commit()
+    return 201, {'message': '%s favorite deleted' % label}
+
+
+ROUTES = [
+    ('GET', re.compile(r'^/(planets|people)/?$'), get_all),
+    ('GET', re.compile(r'^/(planets|people)/(\d+)/?$'), get_one),
+    ('GET', re.compile(r'^/users/favorites/?$'), get_user_fav),
+    ('POST', re.compile(r'^/favorite/(planets|people)/(\d+)/?$'), add_favorite),
+    ('DELETE', re.compile(r'^/favorite/(planets|people)/(\d+)/?$'), delete_favorite),
+]
+
+async def dispatch(request):
+    path_matched = False
+    for method, pattern, handler in ROUTES:
+        match = pattern.match(request.path)
+        if match is None:
+            continue
+        path_matched = True
+        if method == request.method:
+            args = [int(arg) if arg.isdigit() else arg for arg in match.groups()]
+            try:
+                return await handler(request, *args)
+            except APIException as error:
+                return error.status_code, error.to_dict()
+    if path_matched:
+        return 405, {"message": "Method not allowed"}
+    return 404, {"message": "Not found"}
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    status, payload = await dispatch(Request(scope, body))
+    data = json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(data)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': data})
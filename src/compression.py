@@ -0,0 +1,58 @@
+import gzip
+from flask import request
+from cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain'}
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+def setup_compression(app):
+    # Bodies that carry an ETag are only a function of that ETag, so their
+    # compressed form is kept and reused instead of compressed again.
+    min_size = app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+    level = app.config.setdefault('COMPRESS_LEVEL', 6)
+    compressed_bodies = LRUCache(maxsize=app.config.setdefault('COMPRESS_CACHE_SIZE', 256), ttl=3600)
+    encodings = ['br', 'gzip'] if brotli else ['gzip']
+
+    @app.after_request
+    def compress_response(response):
+        response.vary.add('Accept-Encoding')
+        if response.status_code == 304:
+            etag, weak = response.get_etag()
+            # a weak tag that matched can only come from a compressed 200, the
+            # 304 has to carry that same validator
+            if (etag and not weak and request.accept_encodings.best_match(encodings)
+                    and not request.if_none_match.contains(etag)):
+                response.set_etag(etag, weak=True)
+            return response
+        if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        encoding = request.accept_encodings.best_match(encodings)
+        if encoding is None or response.content_length < min_size:
+            return response
+
+        etag, weak = response.get_etag()
+        key = (etag, encoding)
+        body = compressed_bodies.get(key) if etag else None
+        if body is None:
+            body = compress(response.get_data(), encoding, level)
+            if etag:
+                compressed_bodies.set(key, body)
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        if etag:
+            # same representation, different bytes: only weakly equal (as nginx does)
+            response.set_etag(etag, weak=True)
+        return response
+
+    return compressed_bodies
@@ -0,0 +1,208 @@
+import csv
+import io
+import itertools
+import json
+import os
+import re
+from sqlalchemy import exc, select, update
+from models import db, TableVersion, catalog_snapshots
+
+FORMATS = ('json', 'ndjson', 'csv')
+EXTENSIONS = {'.json': 'json', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.csv': 'csv'}
+
+class CatalogImportError(Exception):
+    pass
+
+def guess_format(path):
+    fmt = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        raise CatalogImportError('Cannot tell the format of %s, pass --format' % path)
+    return fmt
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+def iter_json_array(f, chunk_size=1 << 16):
+    # Decodes one element of a top level JSON array at a time, the file is
+    # read in chunks and never held in memory as a whole. pos walks the
+    # buffer, consumed text is only cut off when the next chunk comes in.
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size)
+    pos = WHITESPACE.match(buffer).end()
+    while pos == len(buffer):
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        buffer = chunk
+        pos = WHITESPACE.match(buffer).end()
+    if not buffer.startswith('[', pos):
+        raise CatalogImportError('Expected a JSON array')
+    pos += 1
+    eof = False
+    while True:
+        pos = WHITESPACE.match(buffer, pos).end()
+        if buffer.startswith(',', pos):
+            pos = WHITESPACE.match(buffer, pos + 1).end()
+        if buffer.startswith(']', pos):
+            return
+        item = end = None
+        if pos < len(buffer):
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                pass
+        # an element ending exactly at the chunk boundary may be cut short (a number)
+        if end is None or (end == len(buffer) and not eof):
+            if eof:
+                raise CatalogImportError('Truncated or invalid JSON array')
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+        pos = end
+
+def iter_ndjson(f):
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            raise CatalogImportError('Invalid JSON on line %d' % number)
+
+def iter_records(f, fmt):
+    if fmt == 'json':
+        return iter_json_array(f)
+    if fmt == 'csv':
+        return csv.DictReader(f)
+    return iter_ndjson(f)
+
+def record_name(record, max_length):
+    # records are plain names or objects with a name, like the SWAPI dumps
+    name = record.get('name') if isinstance(record, dict) else record
+    if not isinstance(name, str):
+        return None
+    name = name.strip()
+    if not name or len(name) > max_length:
+        return None
+    return name
+
+def copy_names(connection, model, names):
+    # PostgreSQL COPY, a single round trip for the whole batch
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([name] for name in names)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert('COPY "%s" (name) FROM STDIN WITH (FORMAT csv)' % model.__tablename__, buffer)
+
+def insert_names(connection, model, names):
+    if connection.dialect.name == 'postgresql' and connection.dialect.driver == 'psycopg2':
+        copy_names(connection, model, names)
+    else:
+        connection.execute(model.__table__.insert(), [{"name": name} for name in names])
+
+def bump_version(connection, table):
+    updated = connection.execute(
+        update(TableVersion.__table__).where(TableVersion.name == table).values(version=TableVersion.version + 1)
+    ).rowcount
+    if not updated:
+        connection.execute(TableVersion.__table__.insert(), {"name": table, "version": 1})
+
+def insert_batch(model, names, row_by_row):
+    # One transaction per batch; the table version is bumped in it, like
+    # TableVersion.bump, so readers never see the rows without the new version
+    with db.engine.begin() as connection:
+        existing = {row[0] for row in connection.execute(select(model.name).where(model.name.in_(names)))}
+        new_names = [name for name in names if name not in existing]
+        if not new_names:
+            return 0
+        if not row_by_row:
+            insert_names(connection, model, new_names)
+            inserted = len(new_names)
+        else:
+            inserted = 0
+            for name in new_names:
+                try:
+                    with connection.begin_nested():
+                        connection.execute(model.__table__.insert(), {"name": name})
+                    inserted += 1
+                except exc.IntegrityError:
+                    pass
+        if inserted:
+            bump_version(connection, model.__tablename__)
+    return inserted
+
+def import_batch(model, names):
+    """Insert the names not in the table yet, returns how many were inserted."""
+    names = list(dict.fromkeys(names))
+    try:
+        return insert_batch(model, names, row_by_row=False)
+    except (exc.IntegrityError, db.engine.dialect.dbapi.IntegrityError):
+        # someone else inserted some of these meanwhile, the batch was rolled
+        # back, redo it one row at a time
+        return insert_batch(model, names, row_by_row=True)
+
+def read_progress(path, table):
+    try:
+        with open(path) as f:
+            progress = json.load(f)
+    except FileNotFoundError:
+        return None
+    if progress.get('table') != table:
+        raise CatalogImportError('%s belongs to an import into %s, pass --restart to discard it' % (path, progress.get('table')))
+    return progress
+
+def write_progress(path, progress):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, path)
+
+def import_catalog(model, path, fmt=None, batch_size=1000, restart=False, echo=print):
+    # Progress is saved next to the input after every committed batch. A
+    # rerun skips the records already handled; if it died between commit and
+    # save, the batch is redone and its names are simply found existing.
+    fmt = fmt or guess_format(path)
+    progress_path = path + '.progress'
+    table = model.__tablename__
+    progress = None if restart else read_progress(progress_path, table)
+    if progress is None:
+        progress = {"table": table, "records": 0, "inserted": 0, "skipped": 0, "invalid": 0}
+    elif progress['records']:
+        echo('Resuming after %d records' % progress['records'])
+
+    max_length = model.name.type.length
+    # utf-8-sig drops the byte order mark Excel and friends put in front
+    with open(path, newline='' if fmt == 'csv' else None, encoding='utf-8-sig') as f:
+        records = itertools.islice(iter_records(f, fmt), progress['records'], None)
+        batch = []
+        handled = 0
+        for record in records:
+            handled += 1
+            name = record_name(record, max_length)
+            if name is None:
+                progress['invalid'] += 1
+            else:
+                batch.append(name)
+            if len(batch) >= batch_size:
+                flush_batch(model, batch, handled, progress, progress_path, echo)
+                batch, handled = [], 0
+        flush_batch(model, batch, handled, progress, progress_path, echo)
+
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    snapshot = catalog_snapshots.get(table)
+    if snapshot is not None and progress['inserted']:
+        snapshot.rebuild()
+    return progress
+
+def flush_batch(model, batch, handled, progress, progress_path, echo):
+    if not handled:
+        return
+    inserted = import_batch(model, batch) if batch else 0
+    progress['records'] += handled
+    progress['inserted'] += inserted
+    progress['skipped'] += len(batch) - inserted
+    write_progress(progress_path, progress)
+    echo('%(records)d records, %(inserted)d inserted, %(skipped)d skipped, %(invalid)d invalid' % progress)
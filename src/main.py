@@ -1,26 +1,148 @@
 import os
+import click
 from flask import Flask, request, jsonify, url_for, render_template, redirect
-from flask_migrate import Migrate
-from flask_swagger import swagger
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
+from utils import APIException, generate_sitemap, get_page_args, serialize_page
+from utils import wants_stream, stream_response, etag_by_version, bulk_names, bulk_summary
+from utils import get_export_format, export_response, export_lines
+from utils import get_search_args, serialize_search_page, batch_ids, get_fields, pick_fields, serialize_row
 from admin import setup_admin
-from models import db, User, Planet, Character, FavoritePlanet, FavoriteCharacter
+from pool import engine_options_from_env, get_pool_stats
+from metrics import setup_metrics
+from profiler import setup_profiler
+from querystats import setup_query_stats, parse_budgets
+from compression import setup_compression
+from importer import import_catalog, CatalogImportError, FORMATS
+from snapshot import setup_catalog_snapshot
+from ratelimit import setup_ratelimit, parse_route_limits
+from werkzeug.middleware.proxy_fix import ProxyFix
+from models import db, catalog_cache, catalog_snapshots, User, Planet, Character, FavoritePlanet, FavoriteCharacter
+from models import apply_favorites_batch, TokenUser
 from sqlalchemy import exc
 from flask_jwt_extended import JWTManager, create_access_token
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required, get_jwt_identity, current_user
 
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options_from_env(app.config['SQLALCHEMY_DATABASE_URI'])
+app.config['PAGE_DEFAULT_LIMIT'] = int(os.environ.get('PAGE_DEFAULT_LIMIT', 50))
+app.config['PAGE_MAX_LIMIT'] = int(os.environ.get('PAGE_MAX_LIMIT', 500))
+app.config['STREAM_BATCH_SIZE'] = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+app.config['BULK_BATCH_SIZE'] = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+app.config['POPULAR_MAX_LIMIT'] = int(os.environ.get('POPULAR_MAX_LIMIT', 100))
+app.config['FAVORITES_BATCH_MAX_IDS'] = int(os.environ.get('FAVORITES_BATCH_MAX_IDS', 1000))
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', '0') == '1'
+app.config['RATELIMIT_DEFAULT'] = os.environ.get('RATELIMIT_DEFAULT', '120/60')
+app.config['RATELIMIT_ROUTES'] = parse_route_limits(os.environ.get('RATELIMIT_ROUTES', 'create_token=10/60,signup=10/60'))
+if os.environ.get('RATELIMIT_STORAGE'):
+    app.config['RATELIMIT_STORAGE'] = os.environ['RATELIMIT_STORAGE']
+app.config['QUERY_STRICT'] = os.environ.get('QUERY_STRICT', '0') == '1'
+app.config['QUERY_BUDGET'] = int(os.environ.get('QUERY_BUDGET', 20))
+app.config['QUERY_BUDGETS'] = parse_budgets(os.environ.get('QUERY_BUDGETS', ''))
+app.config['QUERY_REPEAT_LIMIT'] = int(os.environ.get('QUERY_REPEAT_LIMIT', 3))
+app.config['QUERY_STATS_LOG'] = os.environ.get('QUERY_STATS_LOG', '0') == '1'
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_SLOW_MS'] = int(os.environ.get('PROFILE_SLOW_MS', 0))
+app.config['PROFILE_INTERVAL_MS'] = int(os.environ.get('PROFILE_INTERVAL_MS', 5))
+app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN')
+if os.environ.get('PROFILE_DIR'):
+    app.config['PROFILE_DIR'] = os.environ['PROFILE_DIR']
 app.config["JWT_SECRET_KEY"] = "super-secret"  # Change this "super secret" with something else!
 jwt = JWTManager(app)
-MIGRATE = Migrate(app, db)
+# number of proxies in front of the app (1 on Heroku), so request.remote_addr is the client
+if int(os.environ.get('TRUSTED_PROXIES', 0)):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ['TRUSTED_PROXIES']))
+# before the rate limiter, so rejected requests are timed and counted too
+setup_metrics(app)
+setup_ratelimit(app)
+# Flask-Migrate pulls in Alembic, only the `flask` CLI (flask db ...) needs it
+if os.environ.get('FLASK_RUN_FROM_CLI') == 'true':
+    from flask_migrate import Migrate
+    MIGRATE = Migrate(app, db)
 db.init_app(app)
 CORS(app)
-setup_admin(app)
+if os.environ.get('ADMIN_ENABLED', '1') == '1':
+    setup_admin(app)
+setup_query_stats(app)
+# opt-in, nothing is registered unless PROFILE_SAMPLE_RATE or PROFILE_SLOW_MS is set
+setup_profiler(app)
+# workers on a host share one mmapped id -> name catalog instead of querying it
+if os.environ.get('CATALOG_SNAPSHOT_DIR'):
+    setup_catalog_snapshot(app, os.environ['CATALOG_SNAPSHOT_DIR'])
+compressed_bodies = setup_compression(app)
+
+# Handle/serialize errors like a JSON object
+@app.errorhandler(APIException)
+def handle_invalid_usage(error):
+    return jsonify(error.to_dict()), error.status_code
+
+# The name travels in the token, so protected routes know the caller
+# without a query. Tokens without it go through the cached lookup.
+@jwt.user_lookup_loader
+def user_lookup_callback(_jwt_header, jwt_data):
+    if "name" in jwt_data:
+        return TokenUser(jwt_data["sub"], jwt_data["name"])
+    return User.get_token_user(jwt_data["sub"])
+
+def create_user_token(user):
+    return create_access_token(identity=user.id, additional_claims={"name": user.name})
+
+def page_args():
+    return get_page_args(request.args, app.config['PAGE_DEFAULT_LIMIT'], app.config['PAGE_MAX_LIMIT'])
+
+def search_args():
+    return get_search_args(request.args, app.config['PAGE_DEFAULT_LIMIT'], app.config['PAGE_MAX_LIMIT'])
+
+def popular_limit():
+    limit = request.args.get('limit', 10, type=int)
+    if limit < 1:
+        raise APIException('limit must be a positive integer', status_code=400)
+    return min(limit, app.config['POPULAR_MAX_LIMIT'])
+
+@app.cli.command('rebuild-favorite-counts')
+def rebuild_favorite_counts():
+    """Recompute favorite_count on planets and characters from the favorites tables."""
+    Planet.rebuild_favorite_counts()
+    Character.rebuild_favorite_counts()
+    print('Favorite counts rebuilt')
+
+@app.cli.command('import-catalog')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--into', 'table', type=click.Choice(['planets', 'people']), required=True)
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Defaults to the file extension.')
+@click.option('--batch-size', type=int, help='Rows per insert and commit, defaults to BULK_BATCH_SIZE.')
+@click.option('--restart', is_flag=True, help='Ignore the progress of an earlier interrupted run.')
+def import_catalog_command(path, table, fmt, batch_size, restart):
+    """Import planet or character names from a JSON array, NDJSON or CSV file."""
+    model = Planet if table == 'planets' else Character
+    try:
+        progress = import_catalog(model, path, fmt, batch_size or app.config['BULK_BATCH_SIZE'], restart, click.echo)
+    except CatalogImportError as e:
+        raise click.ClickException(str(e))
+    click.echo('Done: %(inserted)d inserted, %(skipped)d already there, %(invalid)d invalid' % progress)
+
+@app.cli.command('export-favorites')
+@click.argument('table', type=click.Choice(['planets', 'people']))
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default='ndjson')
+@click.option('--names', 'with_names', is_flag=True, help='Add the user and item names.')
+@click.option('--output', type=click.File('w'), default='-', help='Defaults to stdout.')
+def export_favorites_command(table, fmt, with_names, output):
+    """Stream every favorite planet or character as NDJSON or CSV."""
+    model = FavoritePlanet if table == 'planets' else FavoriteCharacter
+    for line in export_lines(model.export_rows(app.config['STREAM_BATCH_SIZE'], with_names), fmt):
+        output.write(line)
+
+@app.cli.command('rebuild-catalog-snapshot')
+def rebuild_catalog_snapshot():
+    """Rewrite the catalog snapshot files from the database (needs CATALOG_SNAPSHOT_DIR)."""
+    for snapshot in catalog_snapshots.values():
+        snapshot.rebuild(force=True)
+        print('Rebuilt %s' % snapshot.path)
 
 @app.route('/')
 def sitemap():
@@ -36,15 +158,20 @@ def create_token():
     if user is None:
         return jsonify({"msg": "Bad name or password"}), 401
     
-    access_token = create_access_token(identity=user.id)
+    access_token = create_user_token(user)
     return jsonify({ "token": access_token,"user_name": user.name ,"user_id": user.id })
 
 
 #-------------- USERS -----------------
 @app.route('/user', methods=['GET'])
 def get_all_users():
-    users = User.query.all()
-    return jsonify([user.serialize() for user in users]), 200
+    fields = get_fields(request.args, User)
+    if wants_stream(request):
+        return stream_response(User.iter_all(app.config['STREAM_BATCH_SIZE'], fields), fields)
+
+    limit, after = page_args()
+    users = User.get_page(limit, after, fields)
+    return jsonify(serialize_page(users, limit, fields)), 200
 
 #--------SIGNUP-----------
 @app.route('/signup', methods=['POST'])
@@ -67,25 +194,28 @@ def signup():
 
     try:
         user = myUser.create()
-        access_token = create_access_token(identity=user.id)
+        access_token = create_user_token(user)
         return jsonify({'message': 'User created', 'access_token':access_token}), 201
     except exc.IntegrityError:
         return jsonify({'message': 'Data provided is not valid'})
 
 #----------- PLANETS -------------------
 @app.route('/planets', methods=['GET'])
+@etag_by_version('planets')
 def get_all_planets():
-    planets= Planet.get_all()
+    fields = get_fields(request.args, Planet)
+    if wants_stream(request):
+        return stream_response(Planet.iter_all(app.config['STREAM_BATCH_SIZE'], fields), fields)
 
-    if not planets:
+    limit, after = page_args()
+    planets= Planet.get_page(limit, after, fields)
+
+    if not planets and after is None:
         return jsonify({
             "message": "Planet doesnt exist"
         }), 500
 
-    return jsonify([
-         planet.serialize()
-         for planet in planets
-        ]), 200
+    return jsonify(serialize_page(planets, limit, fields)), 200
 
 
 @app.route('/planets', methods=['POST'])
@@ -108,37 +238,63 @@ def create_planet():
     except exc.IntegrityError:
         return jsonify({'message': 'Data provided is not valid'})
 
+@app.route('/planets/search', methods=['GET'])
+def search_planets():
+    q, prefix, limit, offset = search_args()
+    planets = Planet.search(q, prefix, limit, offset)
+    return jsonify(serialize_search_page(planets, limit, offset)), 200
+
+@app.route('/planets/popular', methods=['GET'])
+def get_popular_planets():
+    limit = popular_limit()
+    planets = Planet.get_popular(limit)
+    return jsonify({"results": [planet._asdict() for planet in planets]}), 200
+
+@app.route('/planets/bulk', methods=['POST'])
+def create_planets_bulk():
+    names = bulk_names(request.get_json(silent=True))
+    results = Planet.bulk_create(names, app.config['BULK_BATCH_SIZE'])
+    return jsonify(bulk_summary(results)), 201
+
 @app.route('/planets/<int:id>', methods=['GET'])
+@etag_by_version('planets')
 def get_planet_id(id):
-    planetsID = Planet.query.get(id)
+    fields = get_fields(request.args, Planet)
+    planetsID = Planet.get_cached(id)
 
-    if planetsID: return jsonify(planetsID.serialize()), 200
+    if planetsID: return jsonify(pick_fields(planetsID, fields)), 200
+    raise APIException('Planet not found', status_code=404)
 
 @app.route('/planets/<int:id>', methods=['DELETE'])
 def delete_planet_id(id):
     planet = Planet.query.get(id)
-    
+    if planet is None:
+        raise APIException('Planet not found', status_code=404)
+
     try:
-        db.session.delete(planet)
-        db.session.commit()
+        planet.delete()
         return jsonify({'message': 'Planet deleted'}), 201
     except exc.IntegrityError:
+        db.session.rollback()
         return jsonify({'message': 'Data provided is not valid'})
 
 #----------- CHARACTERS ----------------
 @app.route('/people', methods=['GET'])
+@etag_by_version('characters')
 def get_all_people():
-    charNames= Character.get_all()
+    fields = get_fields(request.args, Character)
+    if wants_stream(request):
+        return stream_response(Character.iter_all(app.config['STREAM_BATCH_SIZE'], fields), fields)
 
-    if not charNames:
+    limit, after = page_args()
+    charNames= Character.get_page(limit, after, fields)
+
+    if not charNames and after is None:
         return jsonify({
             "message": "People doesnt exist"
         }), 500
 
-    return jsonify([
-         charName.serialize()
-         for charName in charNames
-        ]), 200
+    return jsonify(serialize_page(charNames, limit, fields)), 200
 
 
 @app.route('/people', methods=['POST'])
@@ -161,21 +317,53 @@ def create_people():
     except exc.IntegrityError:
         return jsonify({'message': 'Data provided is not valid'})
 
+@app.route('/people/search', methods=['GET'])
+def search_people():
+    q, prefix, limit, offset = search_args()
+    characters = Character.search(q, prefix, limit, offset)
+    return jsonify(serialize_search_page(characters, limit, offset)), 200
+
+@app.route('/people/popular', methods=['GET'])
+def get_popular_people():
+    limit = popular_limit()
+    characters = Character.get_popular(limit)
+    return jsonify({"results": [character._asdict() for character in characters]}), 200
+
+@app.route('/people/bulk', methods=['POST'])
+def create_people_bulk():
+    names = bulk_names(request.get_json(silent=True))
+    results = Character.bulk_create(names, app.config['BULK_BATCH_SIZE'])
+    return jsonify(bulk_summary(results)), 201
+
 @app.route('/people/<int:id>', methods=["GET"])
+@etag_by_version('characters')
 def get_person_id(id):
-    personID = Character.query.get(id)
+    fields = get_fields(request.args, Character)
+    personID = Character.get_cached(id)
+
+    if personID: return jsonify(pick_fields(personID, fields)), 200
+    raise APIException('Character not found', status_code=404)
+
+#------------- STATS -----------------------
+@app.route('/stats/cache', methods=['GET'])
+def get_cache_stats():
+    return jsonify(catalog_cache.stats()), 200
+
+@app.route('/stats/pool', methods=['GET'])
+def get_pool_stats_route():
+    return jsonify(get_pool_stats(db.engine)), 200
 
-    if personID: return jsonify(personID.serialize()), 200
+@app.route('/stats/compression', methods=['GET'])
+def get_compression_stats():
+    return jsonify(compressed_bodies.stats()), 200
 
 #------------- FAVORITES -----------------------
 
 @app.route('/users/favorites', methods=['GET'])
 @jwt_required()
 def get_user_fav():
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
-    favorite_planets= user.favorite_planets
-    favorite_characters=user.favorite_characters
+    favorite_planets= FavoritePlanet.get_for_user(current_user.id)
+    favorite_characters=FavoriteCharacter.get_for_user(current_user.id)
 
     if not favorite_planets and favorite_characters:
         return jsonify({
@@ -183,15 +371,19 @@ def get_user_fav():
         }), 500
 
     return jsonify([
-        faves.serialize() 
+        faves.serialize_with_name()
         for faves in favorite_characters
         ],[
-        favs.serialize()
+        favs.serialize_with_name()
         for favs in favorite_planets]), 200
     
 @app.route('/favorite/planets', methods=['GET'])
 def get_all_fav_planets():
-    favPlanets= FavoritePlanet.get_all()
+    fields = get_fields(request.args, FavoritePlanet)
+    if wants_stream(request):
+        return stream_response(FavoritePlanet.iter_all(app.config['STREAM_BATCH_SIZE'], fields), fields)
+
+    favPlanets= FavoritePlanet.get_all_rows(fields)
 
     if not favPlanets:
         return jsonify({
@@ -199,65 +391,101 @@ def get_all_fav_planets():
         }), 500
 
     return jsonify([
-         favplanet.serialize()
+         serialize_row(favplanet, fields)
          for favplanet in favPlanets
         ]), 200
 
 
+def export_args():
+    return get_export_format(request.args), request.args.get('names') in ('1', 'true')
+
+@app.route('/favorite/planets/export', methods=['GET'])
+def export_fav_planets():
+    fmt, with_names = export_args()
+    return export_response(FavoritePlanet.export_rows(app.config['STREAM_BATCH_SIZE'], with_names), fmt, 'favorite-planets')
+
+@app.route('/favorite/people/export', methods=['GET'])
+def export_fav_people():
+    fmt, with_names = export_args()
+    return export_response(FavoriteCharacter.export_rows(app.config['STREAM_BATCH_SIZE'], with_names), fmt, 'favorite-people')
+
 @app.route("/favorite/planets/<int:id>", methods=["POST"])
 @jwt_required()
 def favorite_planet(id):
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
-    planet = Planet.query.get(id)
-    myfavPlanet=FavoritePlanet(user=user.id, planet=planet.id)
+    user = current_user
+    planet = Planet.get_cached(id)
+    if planet is None:
+        raise APIException('Planet not found', status_code=404)
+    myfavPlanet=FavoritePlanet(user=user.id, planet=planet["id"])
 
     try:
         favoritePlanet = myfavPlanet.create()
-        return jsonify({"id": user.id,"planet-favorite":planet.name, "name": user.name }), 200
+        return jsonify({"id": user.id,"planet-favorite":planet["name"], "name": user.name }), 200
     except exc.IntegrityError:
+        db.session.rollback()
         return jsonify({'message': 'Data provided is not valid'})
 
 @app.route("/favorite/people/<int:id>", methods=["POST"])
 @jwt_required()
 def favorite_people(id):
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
-    character = Character.query.get(id)
-    myfavCharacter=FavoriteCharacter(user=user.id, character=character.id)
+    user = current_user
+    character = Character.get_cached(id)
+    if character is None:
+        raise APIException('Character not found', status_code=404)
+    myfavCharacter=FavoriteCharacter(user=user.id, character=character["id"])
 
     try:
         favoriteCharacter = myfavCharacter.create()
-        return jsonify({"id": user.id,"character-favorite":character.name, "name": user.name }), 200
+        return jsonify({"id": user.id,"character-favorite":character["name"], "name": user.name }), 200
     except exc.IntegrityError:
+        db.session.rollback()
         return jsonify({'message': 'Data provided is not valid'})
 
 @app.route("/favorite/planets/<int:id>", methods=["DELETE"])
 @jwt_required()
 def delete_planet(id):
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
-    favorite_planet= FavoritePlanet.query.filter_by(user=user.id, planet=id)
+    user = current_user
+    favorite_planet= FavoritePlanet.query.filter_by(user=user.id, planet=id).first()
+    if favorite_planet is None:
+        raise APIException('Planet favorite not found', status_code=404)
     try:
-        db.session.delete(favorite_planet[0])
-        db.session.commit()
+        favorite_planet.delete()
         return jsonify({'message': 'Planet favorite deleted'}), 201
     except exc.IntegrityError:
+        db.session.rollback()
         return jsonify({'message': 'Data provided is not valid'})
 
 @app.route("/favorite/people/<int:id>", methods=["DELETE"])
 @jwt_required()
 def delete_people(id):
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
-    favorite_character= FavoriteCharacter.query.filter_by(user=user.id, character=id)
+    user = current_user
+    favorite_character= FavoriteCharacter.query.filter_by(user=user.id, character=id).first()
+    if favorite_character is None:
+        raise APIException('Character favorite not found', status_code=404)
     try:
-        db.session.delete(favorite_character[0])
-        db.session.commit()
+        favorite_character.delete()
         return jsonify({'message': 'Character favorite deleted'}), 201
     except exc.IntegrityError:
+        db.session.rollback()
         return jsonify({'message': 'Data provided is not valid'})
 
+@app.route("/favorite/batch", methods=["POST", "DELETE"])
+@jwt_required()
+def favorites_batch():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise APIException('You need to send {"planets": [ids], "people": [ids]}', status_code=400)
+    max_ids = app.config['FAVORITES_BATCH_MAX_IDS']
+    planet_ids = batch_ids(body, 'planets', max_ids)
+    character_ids = batch_ids(body, 'people', max_ids)
+
+    try:
+        results = apply_favorites_batch(get_jwt_identity(), planet_ids, character_ids, add=request.method == 'POST')
+        return jsonify(results), 200
+    except exc.IntegrityError:
+        db.session.rollback()
+        return jsonify({'message': 'Favorites changed meanwhile, please retry'}), 409
+
 
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
@@ -0,0 +1,43 @@
+import os
+import time
+from flask import request, g, Response
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST, multiprocess
+
+# With PROMETHEUS_MULTIPROC_DIR set (see gunicorn.conf.py) every worker
+# writes its samples to that directory and /metrics adds them all up.
+
+REQUEST_COUNT = Counter(
+    'http_requests_total', 'Requests handled, by endpoint, method and status code',
+    ['endpoint', 'method', 'status']
+)
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time spent in the view, by endpoint and method',
+    ['endpoint', 'method'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+
+def setup_metrics(app):
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('request_start', None)
+        if start is not None:
+            # the url rule, not the path, so /planets/<int:id> stays one series
+            endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+            REQUEST_COUNT.labels(endpoint, request.method, response.status_code).inc()
+            REQUEST_LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - start)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
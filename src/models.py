@@ -1,10 +1,64 @@
+import os
+from collections import namedtuple
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, ForeignKey, Integer, String, Boolean
+from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, exc, case, column, func, inspect, text
+from sqlalchemy.orm import joinedload
+from cache import LRUCache
 
 db = SQLAlchemy()
+catalog_cache = LRUCache(
+    maxsize=int(os.environ.get('CATALOG_CACHE_SIZE', 1024)),
+    ttl=int(os.environ.get('CATALOG_CACHE_TTL', 60))
+)
+user_cache = LRUCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 4096)),
+    ttl=int(os.environ.get('USER_CACHE_TTL', 300))
+)
+# table name -> CatalogSnapshot, filled by snapshot.setup_catalog_snapshot
+catalog_snapshots = {}
 
-class User(db.Model):
+# what the JWT protected routes need to know about the caller
+TokenUser = namedtuple('TokenUser', ['id', 'name'])
+
+class ColumnReads:
+    # Read only queries that select just the serialized columns. Rows come
+    # back as named tuples and skip ORM instance construction and the
+    # identity map entirely; row._asdict() gives the serialize() output.
+    serialize_columns = ()
+
+    @classmethod
+    def select_columns(cls, fields=None):
+        # id is always selected, the keyset pagination needs it
+        names = ('id',) + tuple(name for name in fields or cls.serialize_columns if name != 'id')
+        return db.session.query(*[getattr(cls, name) for name in names]).order_by(cls.id)
+
+    @classmethod
+    def get_page(cls, limit, after=None, fields=None):
+        snapshot = catalog_snapshots.get(cls.__tablename__)
+        if snapshot is not None:
+            return snapshot.page(limit, after)
+        query = cls.select_columns(fields)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.limit(limit + 1).all()
+
+    @classmethod
+    def get_all_rows(cls, fields=None):
+        snapshot = catalog_snapshots.get(cls.__tablename__)
+        if snapshot is not None:
+            return list(snapshot.rows())
+        return cls.select_columns(fields).all()
+
+    @classmethod
+    def iter_all(cls, batch_size, fields=None):
+        snapshot = catalog_snapshots.get(cls.__tablename__)
+        if snapshot is not None:
+            return snapshot.rows()
+        return cls.select_columns(fields).yield_per(batch_size)
+
+class User(ColumnReads, db.Model):
     __tablename__ = 'users'
+    serialize_columns = ('id', 'name', 'email')
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False, unique=True)
     email = db.Column(db.String(50), nullable=False, unique=True)
@@ -39,16 +93,197 @@ class User(db.Model):
         return user
 
     @classmethod
+    def get_token_user(cls, id):
+        token_user = user_cache.get(id)
+        if token_user is None:
+            row = db.session.query(cls.id, cls.name).filter_by(id=id).first()
+            if row is None:
+                return None
+            token_user = TokenUser(row.id, row.name)
+            user_cache.set(id, token_user)
+        return token_user
+
     def delete(self):
-        user = User.query.get(self.id)
-        db.session.delete(user)
+        db.session.delete(self)
         db.session.commit()
+        user_cache.invalidate(self.id)
         return self
 
-class Planet(db.Model):
+class TableVersion(db.Model):
+    __tablename__ = 'tableVersions'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<TableVersion %r - %s>' % (self.name, self.version)
+
+    @classmethod
+    def get(cls, name):
+        # read once per session, so the ETag and the catalog cache of a
+        # request agree on the version
+        versions = db.session.info.setdefault('table_versions', {})
+        if name not in versions:
+            versions[name] = db.session.query(cls.version).filter_by(name=name).scalar() or 0
+        return versions[name]
+
+    @classmethod
+    def bump(cls, name):
+        # runs inside the caller's transaction, so readers never see a new
+        # version without the rows that go with it
+        updated = cls.query.filter_by(name=name).update({cls.version: cls.version + 1})
+        if not updated:
+            db.session.add(cls(name=name, version=1))
+        # picked up after commit to rebuild the catalog snapshot
+        db.session.info.setdefault('bumped_tables', set()).add(name)
+        db.session.info.get('table_versions', {}).pop(name, None)
+
+def bulk_insert_names(model, names, batch_size):
+    # Every name gets a result entry in input order. Names are checked and
+    # inserted batch by batch (one executemany per batch) inside a single
+    # transaction; a conflicting name only marks its own entry.
+    results = []
+    pending = []
+    seen = set()
+    max_length = model.name.type.length
+    for name in names:
+        if not isinstance(name, str) or not name or len(name) > max_length:
+            results.append({"name": name, "status": "invalid"})
+        elif name in seen:
+            results.append({"name": name, "status": "conflict"})
+        else:
+            seen.add(name)
+            result = {"name": name, "status": "created"}
+            results.append(result)
+            pending.append(result)
+
+    created = 0
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        existing = {row.name for row in db.session.query(model.name).filter(model.name.in_([r["name"] for r in batch]))}
+        to_insert = []
+        for result in batch:
+            if result["name"] in existing:
+                result["status"] = "conflict"
+            else:
+                to_insert.append(result)
+        if not to_insert:
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.execute(model.__table__.insert(), [{"name": r["name"]} for r in to_insert])
+            created += len(to_insert)
+        except exc.IntegrityError:
+            # another writer took some of these names meanwhile, find them one by one
+            for result in to_insert:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(model.__table__.insert(), {"name": result["name"]})
+                    created += 1
+                except exc.IntegrityError:
+                    result["status"] = "conflict"
+
+    if created:
+        TableVersion.bump(model.__tablename__)
+    db.session.commit()
+    return results
+
+def favorites_batch(fav_model, item_model, column, user_id, ids, add):
+    # Set based: two lookups, then one INSERT (executemany) or one DELETE
+    # plus one counter UPDATE, whatever the number of ids. No commit here.
+    fav_column = getattr(fav_model, column)
+    existing = {row.id for row in db.session.query(item_model.id).filter(item_model.id.in_(ids))}
+    faved = {row[0] for row in db.session.query(fav_column).filter(fav_model.user == user_id, fav_column.in_(ids))}
+    results = []
+    changed = []
+    for id in ids:
+        if id not in existing:
+            status = "not_found"
+        elif add and id in faved:
+            status = "exists"
+        elif not add and id not in faved:
+            status = "not_faved"
+        else:
+            status = "added" if add else "removed"
+            changed.append(id)
+        results.append({"id": id, "status": status})
+
+    if changed:
+        if add:
+            db.session.execute(fav_model.__table__.insert(), [{"user": user_id, column: id} for id in changed])
+        else:
+            db.session.query(fav_model).filter(fav_model.user == user_id, fav_column.in_(changed)).delete(synchronize_session=False)
+        delta = 1 if add else -1
+        db.session.query(item_model).filter(item_model.id.in_(changed)).update(
+            {item_model.favorite_count: item_model.favorite_count + delta}, synchronize_session=False)
+    return results
+
+def apply_favorites_batch(user_id, planet_ids, character_ids, add):
+    results = {
+        "planets": favorites_batch(FavoritePlanet, Planet, 'planet', user_id, planet_ids, add),
+        "people": favorites_batch(FavoriteCharacter, Character, 'character', user_id, character_ids, add)
+    }
+    db.session.commit()
+    return results
+
+def export_favorites(fav_model, item_model, column, batch_size, with_names=False):
+    # Column rows straight off a server-side cursor (stream_results), fetched
+    # batch_size at a time, so the export runs in constant memory
+    item_column = getattr(fav_model, column)
+    columns = [fav_model.id, fav_model.user, item_column]
+    if with_names:
+        columns += [User.name.label('user_name'), item_model.name.label(column + '_name')]
+    query = db.session.query(*columns)
+    if with_names:
+        query = query.outerjoin(User, User.id == fav_model.user).outerjoin(item_model, item_model.id == item_column)
+    return query.order_by(fav_model.id).execution_options(stream_results=True).yield_per(batch_size)
+
+_fts_tables = {}
+
+def has_fts_table(table):
+    # the FTS5 tables come from a migration, databases made with create_all() lack them
+    key = (str(db.engine.url), table)
+    if key not in _fts_tables:
+        _fts_tables[key] = inspect(db.engine).has_table(table)
+    return _fts_tables[key]
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def name_search(model, q, prefix, limit, offset):
+    # Matches are ranked exact name, then prefix, then substring, shorter
+    # names first. The index doing the matching depends on the database:
+    # pg_trgm GIN index on PostgreSQL, FTS5 trigram table on SQLite and the
+    # unique name index (prefix only) elsewhere.
+    lower_name = func.lower(model.name)
+    starts_with = lower_name.like(escape_like(q.lower()) + '%', escape='\\')
+    pattern = escape_like(q) + '%' if prefix else '%' + escape_like(q) + '%'
+    dialect = db.engine.dialect.name
+    fts_table = model.__tablename__ + '_fts'
+
+    if dialect == 'postgresql':
+        match = model.name.ilike(pattern, escape='\\')
+    elif dialect == 'sqlite' and len(q) >= 3 and has_fts_table(fts_table):
+        # trigram MATCH needs at least three characters
+        ids = text('SELECT rowid FROM "%s" WHERE "%s" MATCH :fts_query' % (fts_table, fts_table))
+        ids = ids.bindparams(fts_query='"%s"' % q.replace('"', '""')).columns(column('rowid'))
+        match = model.id.in_(ids)
+        if prefix:
+            match = match & starts_with
+    else:
+        match = model.name.like(pattern, escape='\\')
+
+    rank = case((lower_name == q.lower(), 0), (starts_with, 1), else_=2)
+    query = db.session.query(model.id, model.name).filter(match)
+    query = query.order_by(rank, func.length(model.name), model.id)
+    return query.offset(offset).limit(limit + 1).all()
+
+class Planet(ColumnReads, db.Model):
     __tablename__ = 'planets'
+    serialize_columns = ('id', 'name')
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False, unique=True)
+    # denormalized number of favorites, kept up to date by FavoritePlanet.create/delete
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
     faved_by = db.relationship("FavoritePlanet", backref="planet_faved")
 
     def __repr__(self):
@@ -65,21 +300,65 @@ class Planet(db.Model):
         planet = cls.query.all()
         return planet
 
+    @classmethod
+    def get_cached(cls, id):
+        snapshot = catalog_snapshots.get(cls.__tablename__)
+        if snapshot is not None:
+            return snapshot.get(id)
+        # entries carry the table version they were read at, another worker's
+        # write bumps the version and so retires them here as well
+        key = (cls.__tablename__, id)
+        version = TableVersion.get(cls.__tablename__)
+        entry = catalog_cache.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        item = cls.query.get(id)
+        if item is None:
+            return None
+        data = item.serialize()
+        catalog_cache.set(key, (version, data))
+        return data
+
+    @classmethod
+    def bulk_create(cls, names, batch_size):
+        return bulk_insert_names(cls, names, batch_size)
+
+    @classmethod
+    def search(cls, q, prefix, limit, offset):
+        return name_search(cls, q, prefix, limit, offset)
+
+    @classmethod
+    def get_popular(cls, limit):
+        query = db.session.query(cls.id, cls.name, cls.favorite_count)
+        return query.order_by(cls.favorite_count.desc(), cls.id).limit(limit).all()
+
+    @classmethod
+    def rebuild_favorite_counts(cls):
+        count = db.session.query(func.count(FavoritePlanet.id)).filter(FavoritePlanet.planet == cls.id).scalar_subquery()
+        db.session.query(cls).update({cls.favorite_count: count}, synchronize_session=False)
+        db.session.commit()
+
     def create(self):
         db.session.add(self)
+        TableVersion.bump(self.__tablename__)
         db.session.commit()
+        catalog_cache.invalidate((self.__tablename__, self.id))
 
-    @classmethod
     def delete(self):
         db.session.delete(self)
+        TableVersion.bump(self.__tablename__)
         db.session.commit()
+        catalog_cache.invalidate((self.__tablename__, self.id))
         return self
 
-class Character(db.Model):
+class Character(ColumnReads, db.Model):
     __tablename__ = 'characters'
+    serialize_columns = ('id', 'name')
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False, unique=True)
-    faved_by = db.relationship("FavoriteCharacter")
+    # denormalized number of favorites, kept up to date by FavoriteCharacter.create/delete
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
+    faved_by = db.relationship("FavoriteCharacter", backref="character_faved")
 
     def __repr__(self):
         return '<Character %r>' % self.name
@@ -95,26 +374,70 @@ class Character(db.Model):
         data = cls.query.all()
         return data
 
+    @classmethod
+    def get_cached(cls, id):
+        snapshot = catalog_snapshots.get(cls.__tablename__)
+        if snapshot is not None:
+            return snapshot.get(id)
+        # entries carry the table version they were read at, another worker's
+        # write bumps the version and so retires them here as well
+        key = (cls.__tablename__, id)
+        version = TableVersion.get(cls.__tablename__)
+        entry = catalog_cache.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        item = cls.query.get(id)
+        if item is None:
+            return None
+        data = item.serialize()
+        catalog_cache.set(key, (version, data))
+        return data
+
+    @classmethod
+    def bulk_create(cls, names, batch_size):
+        return bulk_insert_names(cls, names, batch_size)
+
+    @classmethod
+    def search(cls, q, prefix, limit, offset):
+        return name_search(cls, q, prefix, limit, offset)
+
+    @classmethod
+    def get_popular(cls, limit):
+        query = db.session.query(cls.id, cls.name, cls.favorite_count)
+        return query.order_by(cls.favorite_count.desc(), cls.id).limit(limit).all()
+
+    @classmethod
+    def rebuild_favorite_counts(cls):
+        count = db.session.query(func.count(FavoriteCharacter.id)).filter(FavoriteCharacter.character == cls.id).scalar_subquery()
+        db.session.query(cls).update({cls.favorite_count: count}, synchronize_session=False)
+        db.session.commit()
+
     def create(self):
         db.session.add(self)
+        TableVersion.bump(self.__tablename__)
         db.session.commit()
-      
+        catalog_cache.invalidate((self.__tablename__, self.id))
 
-    @classmethod
     def delete(self):
-        character = Character.query.get(self.id)
-        db.session.delete(character)
+        db.session.delete(self)
+        TableVersion.bump(self.__tablename__)
         db.session.commit()
-        return self 
+        catalog_cache.invalidate((self.__tablename__, self.id))
+        return self
 
-class FavoritePlanet(db.Model):
+class FavoritePlanet(ColumnReads, db.Model):
     __tablename__ = 'favoritesPlanets'
+    serialize_columns = ('id', 'user', 'planet')
+    __table_args__ = (
+        db.Index('ix_favoritesPlanets_user_planet', 'user', 'planet', unique=True),
+        db.Index('ix_favoritesPlanets_planet', 'planet'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     planet = db.Column(db.Integer, db.ForeignKey("planets.id"))
 
     def __repr__(self):
-        return f"{User.query.get(self.user)} faved {Planet.query.get(self.planet)}"
+        return f"<FavoritePlanet user {self.user} faved planet {self.planet}>"
             
     def serialize(self):
         return {
@@ -122,25 +445,51 @@ class FavoritePlanet(db.Model):
             "user": self.user,
             "planet": self.planet,
         }
+
+    def serialize_with_name(self):
+        data = self.serialize()
+        data["planet_name"] = self.planet_faved.name if self.planet_faved else None
+        return data
         
     @classmethod
     def get_all(cls):
         data = cls.query.all()
         return data
 
+    @classmethod
+    def get_for_user(cls, user_id):
+        # one query, the faved item comes in through a join
+        return cls.query.options(joinedload(cls.planet_faved)).filter_by(user=user_id).order_by(cls.id).all()
+
+    @classmethod
+    def export_rows(cls, batch_size, with_names=False):
+        return export_favorites(cls, Planet, 'planet', batch_size, with_names)
+
     def create(self):
         db.session.add(self)
+        Planet.query.filter_by(id=self.planet).update({Planet.favorite_count: Planet.favorite_count + 1}, synchronize_session=False)
+        db.session.commit()
+        return self
+
+    def delete(self):
+        db.session.delete(self)
+        Planet.query.filter_by(id=self.planet).update({Planet.favorite_count: Planet.favorite_count - 1}, synchronize_session=False)
         db.session.commit()
         return self
 
-class FavoriteCharacter(db.Model):
+class FavoriteCharacter(ColumnReads, db.Model):
     __tablename__ = 'favoritesCharacters'
+    serialize_columns = ('id', 'user', 'character')
+    __table_args__ = (
+        db.Index('ix_favoritesCharacters_user_character', 'user', 'character', unique=True),
+        db.Index('ix_favoritesCharacters_character', 'character'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     character = db.Column(db.Integer, db.ForeignKey("characters.id"))
 
     def __repr__(self):
-        return f"{User.query.get(self.user)} faved {Character.query.get(self.fav_character)}"
+        return f"<FavoriteCharacter user {self.user} faved character {self.character}>"
             
     def serialize(self):
         return {
@@ -149,12 +498,33 @@ class FavoriteCharacter(db.Model):
             "character": self.character,
         }
 
+    def serialize_with_name(self):
+        data = self.serialize()
+        data["character_name"] = self.character_faved.name if self.character_faved else None
+        return data
+
     @classmethod
     def get_all(cls):
         data = cls.query.all()
         return data
 
+    @classmethod
+    def get_for_user(cls, user_id):
+        # one query, the faved item comes in through a join
+        return cls.query.options(joinedload(cls.character_faved)).filter_by(user=user_id).order_by(cls.id).all()
+
+    @classmethod
+    def export_rows(cls, batch_size, with_names=False):
+        return export_favorites(cls, Character, 'character', batch_size, with_names)
+
     def create(self):
         db.session.add(self)
+        Character.query.filter_by(id=self.character).update({Character.favorite_count: Character.favorite_count + 1}, synchronize_session=False)
+        db.session.commit()
+        return self
+
+    def delete(self):
+        db.session.delete(self)
+        Character.query.filter_by(id=self.character).update({Character.favorite_count: Character.favorite_count - 1}, synchronize_session=False)
         db.session.commit()
         return self
@@ -0,0 +1,116 @@
+import os
+import sqlite3
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DisconnectionError, TimeoutError
+from sqlalchemy.pool import Pool, QueuePool
+
+_lock = threading.Lock()
+pool_stats = {}
+
+def reset_pool_stats():
+    with _lock:
+        pool_stats.update({
+            "connects": 0,
+            "checkouts": 0,
+            "checkins": 0,
+            "invalidations": 0,
+            "fork_resets": 0,
+            "waits": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "timeouts": 0
+        })
+
+def _count(key, amount=1):
+    with _lock:
+        pool_stats[key] += amount
+
+class TimedQueuePool(QueuePool):
+    # QueuePool that records how long requests wait for a connection
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            _count("timeouts")
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with _lock:
+                pool_stats["waits"] += 1
+                pool_stats["wait_seconds_total"] += waited
+                pool_stats["wait_seconds_max"] = max(pool_stats["wait_seconds_max"], waited)
+
+def engine_options_from_env(uri):
+    options = {
+        "pool_pre_ping": os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+        "pool_recycle": int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    }
+    # SQLite uses its own single connection pools, sizing does not apply
+    if uri and not uri.startswith('sqlite'):
+        options["poolclass"] = TimedQueuePool
+        options["pool_size"] = int(os.environ.get('DB_POOL_SIZE', 5))
+        options["max_overflow"] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+        options["pool_timeout"] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+    return options
+
+def get_pool_stats(engine):
+    pool = engine.pool
+    with _lock:
+        stats = dict(pool_stats)
+    stats["pool"] = type(pool).__name__
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow()
+        })
+    return stats
+
+# Connections opened before a fork (gunicorn --preload) must never be
+# shared with the child, see "Using Connection Pools with Multiprocessing"
+# in the SQLAlchemy docs.
+@event.listens_for(Pool, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+    _count("connects")
+
+@event.listens_for(Pool, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    _count("checkouts")
+    if connection_record.info.get('pid') != os.getpid():
+        _count("fork_resets")
+        connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+        raise DisconnectionError(
+            "Connection record belongs to pid %s, attempting to check out in pid %s" %
+            (connection_record.info.get('pid'), os.getpid())
+        )
+
+@event.listens_for(Pool, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    _count("checkins")
+
+@event.listens_for(Pool, "invalidate")
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    _count("invalidations")
+
+# pysqlite only issues BEGIN right before a write, so a SAVEPOINT taken
+# after a read is the outermost one and its RELEASE commits. Take over
+# BEGIN as the SQLAlchemy docs suggest ("Serializable isolation /
+# Savepoints / Transactional DDL"), so nested transactions nest on SQLite too.
+@event.listens_for(Pool, "connect")
+def _sqlite_no_implicit_begin(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
+@event.listens_for(Engine, "begin")
+def _sqlite_begin(conn):
+    if conn.dialect.name == 'sqlite' and conn.dialect.driver == 'pysqlite':
+        conn.exec_driver_sql("BEGIN")
+
+reset_pool_stats()
+os.register_at_fork(after_in_child=reset_pool_stats)
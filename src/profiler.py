@@ -0,0 +1,184 @@
+import cProfile
+import glob
+import hmac
+import marshal
+import os
+import pstats
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from flask import request, g, abort, jsonify, Response
+from utils import APIException
+
+# Opt-in request profiling, two independent triggers:
+#  - PROFILE_SAMPLE_RATE: that fraction of requests runs under cProfile,
+#    aggregated per endpoint into <endpoint>.<pid>.prof (pstats / snakeviz).
+#  - PROFILE_SLOW_MS: every request's thread is sampled by a background
+#    thread (cheap), stacks are kept only when the request turns out slower
+#    than the threshold, into <endpoint>.<pid>.folded (flamegraph.pl, speedscope).
+# Every worker writes its own files, /profiles merges them.
+
+ENDPOINT_NAME = re.compile(r'^[\w.]+$')
+
+def fold_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class StackSampler:
+    # samples the stacks of the threads currently serving a request
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.active = {}
+        self._pid = None
+
+    def _ensure_thread(self):
+        # started lazily, so each forked worker gets its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.active.clear()
+            threading.Thread(target=self._run, name='stack-sampler', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            frames = sys._current_frames()
+            for ident, stacks in list(self.active.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[fold_stack(frame)] += 1
+
+    def start(self):
+        self._ensure_thread()
+        self.active[threading.get_ident()] = Counter()
+
+    def stop(self):
+        return self.active.pop(threading.get_ident(), None)
+
+class ProfileStore:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.profiles = {}
+        self.stacks = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, endpoint, suffix):
+        return os.path.join(self.directory, '%s.%d.%s' % (endpoint, os.getpid(), suffix))
+
+    def add_profile(self, endpoint, profile):
+        with self.lock:
+            stats = self.profiles.get(endpoint)
+            if stats is None:
+                stats = self.profiles[endpoint] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            stats.dump_stats(self.path(endpoint, 'prof'))
+
+    def add_stacks(self, endpoint, stacks):
+        with self.lock:
+            total = self.stacks.setdefault(endpoint, Counter())
+            total.update(stacks)
+            with open(self.path(endpoint, 'folded'), 'w') as f:
+                f.writelines('%s %d\n' % item for item in total.items())
+
+    def endpoints(self):
+        found = {}
+        for path in glob.glob(os.path.join(self.directory, '*.*.*')):
+            endpoint, pid, suffix = os.path.basename(path).rsplit('.', 2)
+            found.setdefault(endpoint, set()).add(suffix)
+        return {endpoint: sorted(suffixes) for endpoint, suffixes in found.items()}
+
+    def merged_profile(self, endpoint):
+        paths = glob.glob(os.path.join(self.directory, '%s.*.prof' % glob.escape(endpoint)))
+        if not paths:
+            return None
+        # same bytes Stats.dump_stats writes, loadable with pstats.Stats(path)
+        return marshal.dumps(pstats.Stats(*paths).stats)
+
+    def merged_stacks(self, endpoint):
+        paths = glob.glob(os.path.join(self.directory, '%s.*.folded' % glob.escape(endpoint)))
+        if not paths:
+            return None
+        total = Counter()
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    stack, count = line.rsplit(' ', 1)
+                    total[stack] += int(count)
+        return ''.join('%s %d\n' % item for item in total.items())
+
+def setup_profiler(app):
+    sample_rate = app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    slow_ms = app.config.setdefault('PROFILE_SLOW_MS', 0)
+    if not sample_rate and not slow_ms:
+        return None
+    store = ProfileStore(app.config.setdefault('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'starwars-api-profiles')))
+    sampler = StackSampler(app.config.setdefault('PROFILE_INTERVAL_MS', 5) / 1000.0) if slow_ms else None
+    token = app.config.setdefault('PROFILE_TOKEN', None)
+
+    @app.before_request
+    def start_profiling():
+        g.profile_start = time.perf_counter()
+        if sampler is not None:
+            sampler.start()
+        if sample_rate and random.random() < sample_rate:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler is active on this interpreter (Python 3.12+)
+                return
+            g.profile = profile
+
+    @app.teardown_request
+    def stop_profiling(exc):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.disable()
+        stacks = sampler.stop() if sampler is not None else None
+        start = g.pop('profile_start', None)
+        endpoint = request.endpoint or 'unmatched'
+        if profile is not None:
+            store.add_profile(endpoint, profile)
+        if stacks and start is not None and (time.perf_counter() - start) * 1000 >= slow_ms:
+            store.add_stacks(endpoint, stacks)
+
+    # Without PROFILE_TOKEN the profiles are only on disk
+    if token:
+        def check_token():
+            if not hmac.compare_digest(request.headers.get('X-Profile-Token', ''), token):
+                raise APIException('Not allowed', status_code=403)
+
+        @app.route('/profiles', methods=['GET'])
+        def list_profiles():
+            check_token()
+            return jsonify(store.endpoints()), 200
+
+        @app.route('/profiles/<name>.<any(prof, folded):kind>', methods=['GET'])
+        def get_profile(name, kind):
+            check_token()
+            if not ENDPOINT_NAME.match(name):
+                abort(404)
+            if kind == 'prof':
+                body = store.merged_profile(name)
+                mimetype = 'application/octet-stream'
+            else:
+                body = store.merged_stacks(name)
+                mimetype = 'text/plain'
+            if body is None:
+                raise APIException('No profiles for %s' % name, status_code=404)
+            return Response(body, mimetype=mimetype)
+
+    return store
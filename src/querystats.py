@@ -0,0 +1,73 @@
+import json
+import logging
+import time
+from collections import Counter
+from flask import request, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('querystats')
+
+class QueryBudgetExceeded(AssertionError):
+    # an AssertionError so test clients (TESTING=True) see it raised
+    pass
+
+def parse_budgets(value):
+    # "get_user_fav=3,get_all_planets=2"
+    budgets = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        endpoint, budget = item.split('=')
+        budgets[endpoint.strip()] = int(budget)
+    return budgets
+
+# Registered on the Engine class, so every engine the app creates is
+# covered. Outside a request (CLI, startup) nothing is recorded.
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if not has_request_context():
+        return
+    stats = g.get('query_stats')
+    if stats is None:
+        stats = g.query_stats = {'count': 0, 'time': 0.0, 'statements': Counter()}
+    stats['count'] += 1
+    stats['time'] += elapsed
+    stats['statements'][statement] += 1
+
+def setup_query_stats(app):
+    app.config.setdefault('QUERY_STRICT', False)
+    app.config.setdefault('QUERY_BUDGET', 20)
+    app.config.setdefault('QUERY_BUDGETS', {})
+    app.config.setdefault('QUERY_REPEAT_LIMIT', 3)
+    app.config.setdefault('QUERY_STATS_LOG', False)
+    if app.config['QUERY_STATS_LOG']:
+        logger.setLevel(logging.INFO)
+        logger.addHandler(logging.StreamHandler())
+
+    @app.after_request
+    def report_queries(response):
+        # queries run while a streamed body is sent come after this point
+        stats = g.pop('query_stats', None)
+        count = stats['count'] if stats else 0
+        db_ms = stats['time'] * 1000 if stats else 0.0
+        response.headers.add('Server-Timing', 'db;dur=%.2f;desc="%d queries"' % (db_ms, count))
+        logger.info(json.dumps({
+            "endpoint": request.endpoint,
+            "method": request.method,
+            "status": response.status_code,
+            "queries": count,
+            "db_ms": round(db_ms, 2)
+        }))
+
+        if app.config['QUERY_STRICT'] and stats:
+            budget = app.config['QUERY_BUDGETS'].get(request.endpoint, app.config['QUERY_BUDGET'])
+            if count > budget:
+                raise QueryBudgetExceeded('%s ran %d queries, the budget is %d' % (request.endpoint, count, budget))
+            statement, repeats = stats['statements'].most_common(1)[0]
+            if repeats > app.config['QUERY_REPEAT_LIMIT']:
+                raise QueryBudgetExceeded('%s ran this statement %d times (N+1?): %s' % (request.endpoint, repeats, statement))
+        return response
@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from flask import request, jsonify
+from flask_jwt_extended import decode_token
+
+class SQLiteTokenBuckets:
+    # Token buckets kept in a local SQLite file, so every gunicorn worker
+    # on the host draws from the same buckets without an external service.
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite connections must not cross threads or a fork
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def take(self, key, capacity, rate):
+        """Take one token, returns (allowed, seconds until a token is available)."""
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def purge(self, idle_seconds):
+        connection = self._connection()
+        connection.execute('DELETE FROM buckets WHERE updated < ?', (time.time() - idle_seconds,))
+
+def parse_limit(spec):
+    # "100/60" allows bursts of 100 requests, refilled at 100 per 60 seconds
+    requests, seconds = spec.split('/')
+    return int(requests), int(requests) / float(seconds)
+
+def parse_route_limits(value):
+    # "create_token=5/60,get_all_planets=120/60"
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        endpoint, spec = item.split('=')
+        limits[endpoint.strip()] = spec.strip()
+    return limits
+
+def client_key():
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        try:
+            return 'user:%s' % decode_token(auth[7:])['sub']
+        except Exception:
+            # the view rejects the bad token, meanwhile count it against the address
+            pass
+    return 'ip:%s' % request.remote_addr
+
+def setup_ratelimit(app):
+    app.config.setdefault('RATELIMIT_ENABLED', False)
+    app.config.setdefault('RATELIMIT_DEFAULT', '120/60')
+    app.config.setdefault('RATELIMIT_ROUTES', {})
+    app.config.setdefault('RATELIMIT_EXEMPT', {'metrics', 'static'})
+    app.config.setdefault('RATELIMIT_STORAGE', os.path.join(tempfile.gettempdir(), 'starwars-api-ratelimit.db'))
+    buckets = SQLiteTokenBuckets(app.config['RATELIMIT_STORAGE'])
+    purge_every = 1000
+    calls = [0]
+    # a bucket idle for twice the longest refill window is full again on
+    # every route, dropping it loses nothing
+    specs = [app.config['RATELIMIT_DEFAULT']] + list(app.config['RATELIMIT_ROUTES'].values())
+    purge_idle_seconds = 2 * max(capacity / rate for capacity, rate in map(parse_limit, specs))
+
+    # registered before anything else touches the request, so a client over
+    # its limit is turned away without any database work
+    @app.before_request
+    def check_rate_limit():
+        if not app.config['RATELIMIT_ENABLED'] or request.endpoint in app.config['RATELIMIT_EXEMPT']:
+            return None
+        spec = app.config['RATELIMIT_ROUTES'].get(request.endpoint, app.config['RATELIMIT_DEFAULT'])
+        capacity, rate = parse_limit(spec)
+        allowed, retry_after = buckets.take('%s:%s' % (request.endpoint, client_key()), capacity, rate)
+
+        calls[0] += 1
+        if calls[0] % purge_every == 0:
+            buckets.purge(idle_seconds=purge_idle_seconds)
+
+        if allowed:
+            return None
+        response = jsonify({"message": "Too many requests"})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+        return response
+
+    return buckets
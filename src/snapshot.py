@@ -0,0 +1,152 @@
+import bisect
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from collections import namedtuple
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, select
+from models import db, TableVersion, Planet, Character, catalog_snapshots
+
+# Snapshot file layout: a header, one fixed size entry per row sorted by id,
+# then the utf-8 names back to back. Workers mmap the file, so the pages are
+# shared through the page cache and a lookup is a binary search over entries.
+MAGIC = b'CSN1'
+HEADER = struct.Struct('<4sQI')   # magic, table version, row count
+ENTRY = struct.Struct('<III')     # id, name offset, name length
+
+CatalogRow = namedtuple('CatalogRow', ['id', 'name'])
+
+class SnapshotIds:
+    # sequence view of the entry ids so bisect works on the mmap directly
+    def __init__(self, buffer, count):
+        self.buffer = buffer
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return ENTRY.unpack_from(self.buffer, HEADER.size + index * ENTRY.size)[0]
+
+class SnapshotState:
+    # One opened snapshot file, never changed once built. Readers hold on to
+    # the state they started with, a rebuild only swaps in a new one.
+
+    def __init__(self, buffer, identity):
+        magic, version, count = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError('not a catalog snapshot')
+        self.buffer = buffer
+        self.identity = identity
+        self.version = version
+        self.ids = SnapshotIds(buffer, count)
+        self.names_start = HEADER.size + count * ENTRY.size
+
+    def row(self, index):
+        id, offset, length = ENTRY.unpack_from(self.buffer, HEADER.size + index * ENTRY.size)
+        start = self.names_start + offset
+        return CatalogRow(id, self.buffer[start:start + length].decode())
+
+class CatalogSnapshot:
+
+    def __init__(self, model, path):
+        self.model = model
+        self.table = model.__tablename__
+        self.path = path
+        self._state = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # another worker replaces the file on rebuild, a new inode means reopen
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.rebuild()
+            stat = os.stat(self.path)
+        identity = (stat.st_ino, stat.st_mtime_ns)
+        state = self._state
+        if state is None or state.identity != identity:
+            with self._lock:
+                state = self._state
+                if state is None or state.identity != identity:
+                    with open(self.path, 'rb') as f:
+                        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    state = self._state = SnapshotState(buffer, identity)
+        return state
+
+    def version(self):
+        return self._load().version
+
+    def get(self, id):
+        state = self._load()
+        index = bisect.bisect_left(state.ids, id)
+        if index == len(state.ids) or state.ids[index] != id:
+            return None
+        return state.row(index)._asdict()
+
+    def page(self, limit, after=None):
+        # same shape as ColumnReads.get_page: up to limit + 1 rows after the cursor
+        state = self._load()
+        start = 0 if after is None else bisect.bisect_right(state.ids, after)
+        return [state.row(index) for index in range(start, min(start + limit + 1, len(state.ids)))]
+
+    def rows(self):
+        state = self._load()
+        for index in range(len(state.ids)):
+            yield state.row(index)
+
+    def file_version(self):
+        try:
+            with open(self.path, 'rb') as f:
+                magic, version, count = HEADER.unpack(f.read(HEADER.size))
+            return version
+        except (FileNotFoundError, struct.error):
+            return None
+
+    def rebuild(self, force=False):
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # version first: rows read after it are at least that new, so a
+            # snapshot is never labelled newer than its contents
+            with db.engine.connect() as connection:
+                version = connection.execute(
+                    select(TableVersion.version).where(TableVersion.name == self.table)
+                ).scalar() or 0
+                rows = connection.execute(
+                    select(self.model.id, self.model.name).order_by(self.model.id)
+                ).fetchall()
+            current = self.file_version()
+            if not force and current is not None and current >= version:
+                return
+
+            index = bytearray()
+            names = bytearray()
+            for id, name in rows:
+                data = name.encode()
+                index += ENTRY.pack(id, len(names), len(data))
+                names += data
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, version, len(rows)))
+                f.write(index)
+                f.write(names)
+            os.replace(tmp_path, self.path)
+
+def rebuild_bumped_snapshots(session):
+    for table in session.info.pop('bumped_tables', ()):
+        snapshot = catalog_snapshots.get(table)
+        if snapshot is not None:
+            snapshot.rebuild()
+
+def forget_bumped_tables(session):
+    session.info.pop('bumped_tables', None)
+
+def setup_catalog_snapshot(app, directory):
+    os.makedirs(directory, exist_ok=True)
+    for model in (Planet, Character):
+        catalog_snapshots[model.__tablename__] = CatalogSnapshot(
+            model, os.path.join(directory, model.__tablename__ + '.snapshot'))
+    event.listen(SignallingSession, 'after_commit', rebuild_bumped_snapshots)
+    event.listen(SignallingSession, 'after_rollback', forget_bumped_tables)
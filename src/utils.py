@@ -1,4 +1,11 @@
-from flask import jsonify, url_for
+import base64
+import csv
+import hashlib
+import io
+import json
+from functools import wraps
+from flask import jsonify, url_for, request, make_response, Response, stream_with_context
+from models import TableVersion, catalog_snapshots
 
 class APIException(Exception):
     status_code = 400
@@ -15,13 +22,172 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def encode_cursor(id):
+    return base64.urlsafe_b64encode(str(id).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except ValueError:
+        raise APIException('Invalid cursor', status_code=400)
+
+def get_page_args(args, default_limit, max_limit):
+    limit = args.get('limit', default_limit, type=int)
+    if limit < 1:
+        raise APIException('limit must be a positive integer', status_code=400)
+    after = args.get('after', None)
+    return min(limit, max_limit), decode_cursor(after) if after else None
+
+def get_fields(args, model):
+    # ?fields=id,name limits both the selected columns and the output
+    fields = args.get('fields', None)
+    if not fields:
+        return None
+    fields = tuple(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in model.serialize_columns]
+    if unknown or not fields:
+        raise APIException('Unknown fields: %s, available: %s' % (
+            ', '.join(unknown), ', '.join(model.serialize_columns)), status_code=400)
+    return fields
+
+def pick_fields(data, fields):
+    if fields is None:
+        return data
+    return {field: data[field] for field in fields}
+
+def serialize_row(row, fields=None):
+    return pick_fields(row._asdict(), fields)
+
+def serialize_page(rows, limit, fields=None):
+    # rows holds up to limit + 1 items, the extra one only tells us there is a next page
+    next_cursor = encode_cursor(rows[limit - 1].id) if len(rows) > limit else None
+    return {
+        "results": [serialize_row(row, fields) for row in rows[:limit]],
+        "next": next_cursor
+    }
+
+def get_search_args(args, default_limit, max_limit):
+    q = args.get('q', '').strip()
+    if not q:
+        raise APIException('You need to specify the search text in q', status_code=400)
+    mode = args.get('mode', 'substring')
+    if mode not in ('prefix', 'substring'):
+        raise APIException('mode must be prefix or substring', status_code=400)
+    # search results are ranked, not ordered by id, so the cursor holds an offset
+    limit, offset = get_page_args(args, default_limit, max_limit)
+    return q, mode == 'prefix', limit, offset or 0
+
+def serialize_search_page(rows, limit, offset):
+    next_cursor = encode_cursor(offset + limit) if len(rows) > limit else None
+    return {
+        "results": [row._asdict() for row in rows[:limit]],
+        "next": next_cursor
+    }
+
+def wants_stream(request):
+    if request.args.get('stream') == '1':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+def ndjson_lines(rows, fields=None):
+    for row in rows:
+        yield json.dumps(serialize_row(row, fields)) + '\n'
+
+def stream_response(rows, fields=None):
+    # one JSON document per line, sent as rows come out of the cursor
+    return Response(stream_with_context(ndjson_lines(rows, fields)), mimetype='application/x-ndjson')
+
+def csv_lines(rows, columns):
+    # header first, then one line per row, each flushed as soon as it is written
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+    yield buffer.getvalue()
+
+def query_columns(query):
+    return [description['name'] for description in query.column_descriptions]
+
+def export_lines(query, fmt):
+    if fmt == 'csv':
+        return csv_lines(query, query_columns(query))
+    return ndjson_lines(query)
+
+def get_export_format(args):
+    fmt = args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        raise APIException('format must be ndjson or csv', status_code=400)
+    return fmt
+
+def export_response(query, fmt, filename):
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(export_lines(query, fmt)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (filename, fmt)
+    return response
+
+def etag_by_version(table):
+    # The ETag only depends on the table version and the request, so a
+    # matching If-None-Match is answered without reading any rows
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            snapshot = catalog_snapshots.get(table)
+            version = snapshot.version() if snapshot is not None else TableVersion.get(table)
+            key = '%s:%s:%s:%s' % (table, version, request.full_path, request.headers.get('Accept', ''))
+            etag = hashlib.sha1(key.encode()).hexdigest()
+            # weak comparison: compressed responses carry W/"<etag>"
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.vary.add('Accept')
+            return response
+        return wrapper
+    return decorator
+
+def bulk_names(body):
+    # accepts ["Tatooine", ...] as well as [{"name": "Tatooine"}, ...]
+    if not isinstance(body, list) or not body:
+        raise APIException('You need to send a non empty list of items', status_code=400)
+    return [item.get('name') if isinstance(item, dict) else item for item in body]
+
+def batch_ids(body, key, max_ids):
+    ids = body.get(key, [])
+    if not isinstance(ids, list) or not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+        raise APIException('%s must be a list of ids' % key, status_code=400)
+    if len(ids) > max_ids:
+        raise APIException('At most %s ids per request in %s' % (max_ids, key), status_code=400)
+    return list(dict.fromkeys(ids))
+
+def bulk_summary(results):
+    return {
+        "created": sum(1 for result in results if result["status"] == "created"),
+        "conflicts": sum(1 for result in results if result["status"] == "conflict"),
+        "invalid": sum(1 for result in results if result["status"] == "invalid"),
+        "results": results
+    }
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
     return len(defaults) >= len(arguments)
 
 def generate_sitemap(app):
-    links = ['/admin/']
+    # the url map does not change once the app serves requests, build the page once
+    if 'sitemap' not in app.extensions:
+        app.extensions['sitemap'] = build_sitemap(app)
+    return app.extensions['sitemap']
+
+def build_sitemap(app):
+    links = ['/admin/'] if 'admin' in app.extensions else []
     for rule in app.url_map.iter_rules():
         # Filter out rules we can't navigate to in a browser
         # and rules that require parameters